@@ -1,28 +1,80 @@
+import functools
+import mmap
+import os
 import struct
 import sys
 
 
+# compiled once at import so hot read paths cost a single global load, with no
+# format-string parsing and no class-dict lookup per call
+_S_SHORT = struct.Struct("<h")
+_S_USHORT = struct.Struct("<H")
+_S_INT = struct.Struct("<i")
+_S_UINT = struct.Struct("<I")
+_S_LONG_LONG = struct.Struct("<q")
+_S_FLOAT = struct.Struct("<f")
+_S_DOUBLE = struct.Struct("<d")
+
+
+@functools.lru_cache(maxsize=None)
+def compiled_struct(fmt):
+    """
+    :param fmt: struct-style format string
+    :return: compiled `struct.Struct` for it, cached per format
+    """
+    return struct.Struct(fmt)
+
+
+@functools.lru_cache(maxsize=64)
+def _ints_struct(count):
+    """
+    :param count: number of little-endian ints in the record
+    :return: compiled `struct.Struct` for that record, cached per count
+    """
+    return struct.Struct("<%di" % count)
+
+
 class ByteStream(object):
     """
     Class to read from little-endian formatted bytestream
     """
 
-    LITTLE_ENDIAN_INT_FORMAT = "<i"
-    LITTLE_ENDIAN_SHORT_FORMAT = "<h"
-    LITTLE_ENDIAN_LONG_FORMAT = "<l"
-    LITTLE_ENDIAN_FLOAT_FORMAT = "<f"
-    LITTLE_ENDIAN_DOUBLE_FORMAT = "<d"
-    LITTLE_ENDIAN_LONG_LONG_FORMAT = "<q"
+    __slots__ = ('_path', '_file', '_mmap', '_mv', '_pos', '_size', '_type_ids', '_string_ids')
 
     def __init__(self, path):
         self._path = path
-        self._file = open(self._path, 'r+b')
-        self._file.seek(0, 2)
-        self._size = self._file.tell()
-        self._file.seek(0)
-        self._look_ahead = None
-        self._look_ahead_pos = None
-        self._look_ahead_index = None
+        self._file = open(self._path, 'rb')
+        self._size = os.fstat(self._file.fileno()).st_size
+        try:
+            # map the file read-only so every read below is a zero-copy slice rather than a syscall
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            self._mv = memoryview(self._mmap)
+        except (ValueError, OSError):
+            # mmap cannot map empty files; fall back to an in-memory snapshot
+            self._mmap = None
+            self._mv = memoryview(self._file.read())
+        self._pos = 0
+        # dex id tables, attached by the dex parser once the header is read so items
+        # parsed from this stream can resolve their descriptors
+        self._type_ids = None
+        self._string_ids = None
+
+    @classmethod
+    def from_bytes(cls, data):
+        """
+        :param data: raw bytes holding the full stream content
+        :return: `ByteStream` serving reads from the in-memory data, with no file backing
+        """
+        stream = cls.__new__(cls)
+        stream._path = None
+        stream._file = None
+        stream._mmap = None
+        stream._mv = memoryview(data)
+        stream._size = len(data)
+        stream._pos = 0
+        stream._type_ids = None
+        stream._string_ids = None
+        return stream
 
     @property
     def size(self):
@@ -38,7 +90,6 @@ class ByteStream(object):
             self._offset_on_exit = bytestream.tell()
             self._offset = offset
             self._bytestream = bytestream
-            self._file = bytestream._file
 
         def __enter__(self, *args, **kargs):
             if self._offset is not None:
@@ -53,59 +104,130 @@ class ByteStream(object):
             """
             :return: single byte read from stream (incrementing position in stream)
             """
-            return self._file.read(1)[0] if sys.version_info >= (3,) else ord(self._file.read(1)[0])
+            bytestream = self._bytestream
+            pos = bytestream._pos
+            bytestream._pos = pos + 1
+            return bytestream._mv[pos]
+
+        def _read_struct(self, compiled):
+            """
+            :param compiled: precompiled `struct.Struct` for a single value
+            :return: that value unpacked in-place from the stream, advancing the position
+            """
+            bytestream = self._bytestream
+            pos = bytestream._pos
+            bytestream._pos = pos + compiled.size
+            return compiled.unpack_from(bytestream._mv, pos)[0]
 
         def read_short(self):
             """
             :return: short read from stream, with proper endian-ness in mind
             """
-            return struct.unpack(ByteStream.LITTLE_ENDIAN_SHORT_FORMAT, self._file.read(2))[0]
+            return self._read_struct(_S_SHORT)
 
         def read_int(self):
             """
             :return: int read from stream, with proper endian-ness in mind
             """
-            return struct.unpack(ByteStream.LITTLE_ENDIAN_INT_FORMAT, self._file.read(4))[0]
+            return self._read_struct(_S_INT)
+
+        def read_ushort(self):
+            """
+            :return: unsigned short read from stream, with proper endian-ness in mind
+            """
+            return self._read_struct(_S_USHORT)
+
+        def read_uint(self):
+            """
+            :return: unsigned int read from stream, with proper endian-ness in mind
+            """
+            return self._read_struct(_S_UINT)
 
         def read_long_long(self):
             """
             :return: long read from stream, with proper endian-ness in mind
             """
-            return struct.unpack(ByteStream.LITTLE_ENDIAN_LONG_LONG_FORMAT, self._file.read(8))[0]
+            return self._read_struct(_S_LONG_LONG)
 
         def read_float(self):
             """
             :return: float read from stream, with proper endian-ness in mind
             """
-            return struct.unpack(ByteStream.LITTLE_ENDIAN_FLOAT_FORMAT, self._file.read(4))[0]
+            return self._read_struct(_S_FLOAT)
 
         def read_double(self):
             """
             :return: double read from stream, with proper endian-ness in mind
             """
-            return struct.unpack(ByteStream.LITTLE_ENDIAN_DOUBLE_FORMAT, self._file.read(8))[0]
+            return self._read_struct(_S_DOUBLE)
 
         def read_ints(self, count):
             """
             :param count: the number of ints to read
-            :return: request tuple of int value read from stream, with proper endian-ness in mind
+            :return: requested sequence of int values read from stream, with proper endian-ness in mind
             """
-            return struct.unpack("<%di" % count, self._file.read(count * 4))
+            bytestream = self._bytestream
+            pos = bytestream._pos
+            bytestream._pos = pos + count * 4
+            if sys.byteorder == 'little':
+                # zero-copy typed view; no O(count) format string and no tuple boxing
+                return bytestream._mv[pos:bytestream._pos].cast('i')
+            return _ints_struct(count).unpack_from(bytestream._mv, pos)
 
         def read_leb128(self):
             """
             :return: a Little Endian Base 128 variable-length element from this stream
             """
-            result = 0
-            shift = 0
-            while True:
-                current = self.read_byte()
-                result |= ((current & 0x7f) << shift)
-                if (current & 0x80) == 0:
-                    break
-                shift += 7
-                if shift >= 35:
-                    raise Exception("LEB128 sequence invalid")
+            bytestream = self._bytestream
+            mv = bytestream._mv
+            pos = bytestream._pos
+            # unrolled over the at-most-five bytes of a valid sequence; most values fit in one
+            result = mv[pos]
+            size = 1
+            if result & 0x80:
+                current = mv[pos + 1]
+                result = (result & 0x7f) | ((current & 0x7f) << 7)
+                size = 2
+                if current & 0x80:
+                    current = mv[pos + 2]
+                    result |= (current & 0x7f) << 14
+                    size = 3
+                    if current & 0x80:
+                        current = mv[pos + 3]
+                        result |= (current & 0x7f) << 21
+                        size = 4
+                        if current & 0x80:
+                            current = mv[pos + 4]
+                            if current & 0x80:
+                                raise Exception("LEB128 sequence invalid")
+                            result |= current << 28
+                            size = 5
+            bytestream._pos = pos + size
+            return result
+
+        def read_leb128_many(self, count):
+            """
+            :param count: number of back-to-back LEB128 values to decode
+            :return: list of the decoded values, advancing past all of them
+            """
+            bytestream = self._bytestream
+            mv = bytestream._mv
+            pos = bytestream._pos
+            result = [0] * count
+            for index in range(count):
+                current = mv[pos]
+                pos += 1
+                value = current & 0x7f
+                shift = 7
+                while current & 0x80:
+                    if shift >= 35:
+                        raise Exception("LEB128 sequence invalid")
+                    current = mv[pos]
+                    pos += 1
+                    value |= (current & 0x7f) << shift
+                    shift += 7
+                result[index] = value
+            bytestream._pos = pos
             return result
 
         def read_bytes(self, byte_count):
@@ -113,41 +235,40 @@ class ByteStream(object):
             :param byte_count: number of bytes to read
             :return: requested number of bytes read form stream
             """
-            return bytes(self._file.read(byte_count))
+            return bytes(self._bytestream.read(byte_count))
 
         def read_string(self):
             """
             :return: null-treminated string read from stream
             """
-            pos = self._file.tell()
-            result = ""
-            byte_data = self._file.read(128)
-            while byte_data:
-                fmt = "<%ds" % len(byte_data)
-                delta = struct.unpack(fmt, byte_data)[0].decode('latin-1').split(chr(0))[0]
-                result += delta
-                if len(byte_data) == 128 and len(delta) == 128:
-                    byte_data = self._file.read(128)
-                else:
-                    byte_data = None
-            pos += len(result)
-            self._file.seek(pos)
-            return result
+            bytestream = self._bytestream
+            pos = bytestream._pos
+            # scan for the terminator in C via the backing mmap/bytes object rather than
+            # decoding the stream in 128-byte chunks
+            end = bytestream._mv.obj.find(b'\x00', pos)
+            if end < 0:
+                end = bytestream._size
+            bytestream._pos = end
+            # descriptors and names repeat heavily across a dex file; intern so duplicates
+            # share one object and later comparisons are pointer checks
+            return sys.intern(bytes(bytestream._mv[pos:end]).decode('latin-1'))
 
         def read_fixed_string(self, length):
             """
             :param length: size of fixed-length string to read
             :return: string of given lenght, pulled from this stream
             """
-            fmt = "<%ds" % length
-            return struct.unpack(fmt, self._file.read(length))[0].decode('latin-1')
+            bytestream = self._bytestream
+            pos = bytestream._pos
+            bytestream._pos = pos + length
+            return bytes(bytestream._mv[pos:bytestream._pos]).decode('latin-1')
 
         def read(self, count):
             """
             :param count: number of bytes to read from stream
             :return: count number of bytes, pulled from this stream
             """
-            return self._file.read(count)
+            return self._bytestream.read(count)
 
         def skip(self, count):
             self._bytestream.seek(self._bytestream.tell() + count)
@@ -157,18 +278,28 @@ class ByteStream(object):
         :param string_id: string id to look up
         :return: string value read from byte stream associated with provided string_id
         """
-        with ByteStream.ContiguousReader(self, offset=string_id.data_offset) as reader:
-            # read past unused:
-            reader.read_leb128()
-            return reader.read_string()
+        # string_id -> string is immutable within a dex file, so cache the parsed value on
+        # the id item itself and skip the reader round-trip on repeat lookups
+        descriptor = getattr(string_id, '_descriptor', None)
+        if descriptor is None:
+            with ByteStream.ContiguousReader(self, offset=string_id.data_offset) as reader:
+                # read past unused:
+                reader.read_leb128()
+                descriptor = reader.read_string()
+            string_id._descriptor = descriptor
+        return descriptor
 
     def parse_method_name(self, method_id):
         """
         :param method_id: id for lookup
         :return: string name of method associated with provided method_id
         """
-        string_id = method_id._string_ids[method_id.name_index]
-        return self.parse_descriptor(string_id)
+        name = getattr(method_id, '_method_name', None)
+        if name is None:
+            string_id = self._string_ids[method_id.name_index]
+            name = self.parse_descriptor(string_id)
+            method_id._method_name = name
+        return name
 
     class BaseCollectionReader(object):
         """
@@ -188,10 +319,10 @@ class ByteStream(object):
             self._count = count
             if clazz.FORMAT is None or clazz.FORMAT[0] == '*':
                 self._byte_size = None
-                self._fmt = None
+                self._struct = None
             else:
-                self._fmt = "<" + clazz.FORMAT
-                self._byte_size = struct.calcsize(self._fmt)
+                self._struct = compiled_struct("<" + clazz.FORMAT)
+                self._byte_size = self._struct.size
             self._offset = offset
             self._index = 0
             self._class = clazz
@@ -219,8 +350,8 @@ class ByteStream(object):
             try:
                 self._bytestream.seek(self._curr_offset)
                 if self._byte_size is not None:
-                    elem = self._class(self._bytestream,  struct.unpack(self._fmt,
-                                                                        self._bytestream._file.read(self._byte_size )))
+                    elem = self._class(self._bytestream,
+                                       self._struct.unpack(self._bytestream.read(self._byte_size)))
                 else:
                     elem = self._class(self._bytestream)
                 self._curr_offset = self._bytestream.tell()
@@ -235,52 +366,59 @@ class ByteStream(object):
         def __init__(self, bytestream, clazz, offset=None, count=None):
             super(ByteStream.CollectionReader, self).__init__(bytestream, clazz, offset, count)
             self._offset = offset if offset is not None else bytestream.tell()
+            if self._byte_size is not None:
+                # keep one zero-copy view over the whole table so indexed reads unpack
+                # in place instead of seeking back and forth through the stream
+                end = None if count is None else self._offset + count * self._byte_size
+                self._buf = bytestream._mv[self._offset:end]
             self._parsed = {}
 
         def __getitem__(self, index):
             if self._count is not None and index >= self._count:
                 raise IndexError("Index out of range")
-            if index in self._parsed:
-                return self._parsed[index]
-            start_offset = self._bytestream.tell()
-            self._bytestream.seek(self._offset + index * self._byte_size)
-            try:
-                if self._byte_size is not None:
-                    elem = self._class(self._bytestream,  struct.unpack(self._fmt,
-                                                                        self._bytestream._file.read(self._byte_size )))
-                else:
-                    elem = self._class(self._bytestream)
-                self._parsed[index] = elem
+            elem = self._parsed.get(index)
+            if elem is not None:
                 return elem
-            finally:
-                self._bytestream.seek(start_offset)
-
-        def parse_items(self, count, start=0):
-            """
-            Retrieve list of same-type items from stream.  Offset into stream is unchanged upon exit
-            :param count: number of iteams of type clazz to parse
-            :return: collection of requested number of clazz instances parsed from bytestream
-            """
-            if count != 0:
-                current_offset = self._file.tell()
-                self._bytestream.seek(self._offset + start*size)
+            if self._byte_size is not None:
+                elem = self._class(self._bytestream,
+                                   self._struct.unpack_from(self._buf, index * self._byte_size))
+            else:
+                start_offset = self._bytestream.tell()
+                self._bytestream.seek(self._offset)
                 try:
-                    return clazz.get(self, count)
+                    elem = self._class(self._bytestream)
                 finally:
-                    if offset is not None:
-                        self._file.seek(current_offset)
+                    self._bytestream.seek(start_offset)
+            self._parsed[index] = elem
+            return elem
 
     def tell(self):
         """
         :return: current location within this stream
         """
-        return self._file.tell()
+        return self._pos
 
     def seek(self, pos):
         """
         :param pos: position to seek to within the stream
         :return: position after seek
         """
-        return self._file.seek(pos)
+        self._pos = pos
+        return self._pos
 
+    def read(self, count):
+        """
+        :param count: number of bytes to read from stream
+        :return: zero-copy view of count bytes (or fewer at end of stream), advancing the position
+        """
+        pos = self._pos
+        self._pos = pos + count
+        return self._mv[pos:self._pos]
 
+    def close(self):
+        """
+        Close the underlying file.  Collection readers may still hold exported views into
+        the map, so the mapping itself is left to reference counting.
+        """
+        if self._file is not None:
+            self._file.close()
@@ -1,14 +1,14 @@
+import collections
 import fnmatch
+import functools
 import os
 import re
-import shutil
-import struct
 import sys
-import tempfile
 import zipfile
-from abc import ABCMeta, abstractmethod
+from abc import abstractmethod
+from concurrent import futures
 
-from . import ByteStream
+from . import ByteStream, compiled_struct
 
 
 WORD_LENGTH = 4
@@ -32,8 +32,8 @@ class DexParser(object):
         SIZE_MAGIC_DEX = 3
         SIZE_MAGIC_VERSION = 3
 
-        EXPECTED_DEX = bytes([0x64, 0x65, 0x78]) if sys.version_info >= (3,) else 'dex'
-        EXPECTED_VERSION = bytes([0x30, 0x33, 0x35]) if sys.version_info >= (3,) else '035'
+        EXPECTED_DEX = bytes([0x64, 0x65, 0x78])  # "dex"
+        EXPECTED_VERSION = bytes([0x30, 0x33, 0x35])  # "035"
 
         def __init__(self, bytestream):
             with ByteStream.ContiguousReader(bytestream) as reader:
@@ -95,7 +95,6 @@ class DexParser(object):
         """
         base class for all data items
         """
-        __metaclass__ = ABCMeta
 
         # FORMAT attributes defined here are in convention of Python's struct package, with the
         # exception that "*" at beginning means a variable-sized entity
@@ -110,19 +109,14 @@ class DexParser(object):
                 # have variant-sized or un-type-able objects
                 return [cls(bytestream) for _ in range(count)]
             else:
-                fmt = "<" + cls.FORMAT
-                size = struct.calcsize(fmt)
+                compiled = compiled_struct("<" + cls.FORMAT)
                 with ByteStream.ContiguousReader(bytestream) as reader:
-                    if sys.version_info >= (3,):
-                        return struct.iter_unpack(fmt, reader.read(count * size))
-                    else:
-                        return [cls(bytestream, struct.unpack(fmt, reader.read(size))) for _ in range(count)]
+                    return compiled.iter_unpack(reader.read(count * compiled.size))
 
     class DescribableItem(Item):
         """
         an Item that has a descriptor associated with it via its type
         """
-        __metaclass__ = ABCMeta
 
         def __init__(self, bytestream):
             super(DexParser.DescribableItem, self).__init__(bytestream)
@@ -131,10 +125,10 @@ class DexParser(object):
         def _type_index(self):
             pass
 
-        @property
+        @functools.cached_property
         def descriptor(self):
-            type_id = self._type_ids[self._type_index()]
-            string_id = self._string_ids[type_id.descriptor_index]
+            type_id = self._bytestream._type_ids[self._type_index()]
+            string_id = self._bytestream._string_ids[type_id.descriptor_index]
             return self._bytestream.parse_descriptor(string_id)
 
     class Annotation(Item):
@@ -196,8 +190,7 @@ class DexParser(object):
             with ByteStream.ContiguousReader(bytestream) as reader:
                 self.class_annotations_offset, field_size, annotated_method_size, annotated_parameter_size = \
                     reader.read_ints(4)
-                fmt = "<" + DexParser.Annotation.FORMAT
-                size = struct.calcsize(fmt)
+                size = compiled_struct("<" + DexParser.Annotation.FORMAT).size
                 self.field_annotations = ByteStream.CollectionReader(bytestream, count=field_size, clazz=DexParser.Annotation)
                 reader.skip(field_size * size)
                 self.method_annotations = ByteStream.CollectionReader(bytestream, count=annotated_method_size,
@@ -206,27 +199,44 @@ class DexParser(object):
                 self.parameter_annotations = ByteStream.CollectionReader(bytestream, count=annotated_parameter_size,
                                                                          clazz=DexParser.Annotation)
                 self._parsed_annotations = {}
+                self._parsed = False
 
-        def get_methods_with_annotation(self, target_descriptor, method_ids):
+        def get_methods_with_annotation(self, target_type_index, method_ids):
             """
-            :param target_descriptor: annotation of interest, in descriptor format
+            :param target_type_index: type index of the annotation of interest, or -1 if the
+            annotation does not exist in this dex file
             :param method_ids: list of MethodIdItems for querying name
-            :return: all vritual methods int his directory of that ar annotated with given descriptor
+            :return: all vritual methods int his directory of that ar annotated with given annotation type
             """
-            if not self._parsed_annotations:
+            if target_type_index < 0:
+                return set()
+            if not self._parsed:
+                self._parsed = True
+                # the same annotation set is commonly shared by many methods (e.g. plain
+                # @Test), so parse each distinct offset once and reuse its type indices
+                type_indices_by_offset = {}
                 for annotation in self.method_annotations:
-                    if annotation.annotations_offset == 0:
+                    offset = annotation.annotations_offset
+                    if offset == 0:
                         continue
-                    with ByteStream.ContiguousReader(self._bytestream, offset=annotation.annotations_offset):
-                        entries = DexParser.AnnotationSetItem(self._bytestream)
-                    for entry in entries:
-                        with ByteStream.ContiguousReader(self._bytestream, offset=entry.annotation_offset):
-                            item = DexParser.AnnotationItem(self._bytestream)
-                        method_id = method_ids[annotation.index]
-                        method_descriptor = self._bytestream.parse_method_name(method_id)
-                        self._parsed_annotations.setdefault(item.encoded_annotation.descriptor,[]).\
-                            append(method_descriptor)
-            return self._parsed_annotations.get(target_descriptor) or []
+                    type_indices = type_indices_by_offset.get(offset)
+                    if type_indices is None:
+                        type_indices = []
+                        # an annotation set is just a count followed by that many u32
+                        # offsets; read them in one shot instead of materializing
+                        # AnnotationSetItem/AnnotationOffsetItem objects per entry
+                        with ByteStream.ContiguousReader(self._bytestream, offset=offset) as reader:
+                            entry_offsets = reader.read_ints(reader.read_int())
+                        for annotation_offset in entry_offsets:
+                            with ByteStream.ContiguousReader(self._bytestream, offset=annotation_offset):
+                                item = DexParser.AnnotationItem(self._bytestream)
+                            # key by the annotation's type index; no descriptor decode needed
+                            type_indices.append(item.encoded_annotation.type_index)
+                        type_indices_by_offset[offset] = type_indices
+                    method_descriptor = self._bytestream.parse_method_name(method_ids[annotation.index])
+                    for type_index in type_indices:
+                        self._parsed_annotations.setdefault(type_index, set()).add(method_descriptor)
+            return self._parsed_annotations.get(target_type_index) or set()
 
     class ClassDefItem(DescribableItem):
         FORMAT = "iiiiiiii"
@@ -256,7 +266,7 @@ class DexParser(object):
             """
             if self.super_class_index < 0:
                 return None
-            return self._type_ids[self.super_class_index]
+            return self._bytestream._type_ids[self.super_class_index]
 
         def has_direct_super_class(self, descriptors):
             """
@@ -274,13 +284,10 @@ class DexParser(object):
         def __init__(self, bytestream):
             super(DexParser.ClassDefData, self).__init__(bytestream)
             with ByteStream.ContiguousReader(bytestream) as reader:
-                static_fields_size = reader.read_leb128()
-                instance_fields_size = reader.read_leb128()
-                direct_methods_size = reader.read_leb128()
-                virtual_methods_size = reader.read_leb128()
+                (static_fields_size, instance_fields_size,
+                 direct_methods_size, virtual_methods_size) = reader.read_leb128_many(4)
 
-                fmt = "<" + DexParser.Annotation.FORMAT
-                size = struct.calcsize(fmt)
+                size = compiled_struct("<" + DexParser.Annotation.FORMAT).size
                 self.static_fields = ByteStream.IterReader(bytestream, count=static_fields_size,
                                                            clazz=DexParser.EncodedField)
                 reader.skip(size * static_fields_size)
@@ -299,8 +306,7 @@ class DexParser(object):
         def __init__(self, bytestream):
             super(DexParser.EncodedAnnotation, self).__init__(bytestream)
             with ByteStream.ContiguousReader(bytestream) as reader:
-                self.type_index = reader.read_leb128()
-                count = reader.read_leb128()
+                self.type_index, count = reader.read_leb128_many(2)
                 self.elements = ByteStream.CollectionReader(bytestream, count=count,
                                                             clazz=DexParser.AnnotationOffsetItem)
 
@@ -313,8 +319,7 @@ class DexParser(object):
         def __init__(self, bytestream):
             super(DexParser.EncodedItem, self).__init__(bytestream)
             with ByteStream.ContiguousReader(bytestream) as reader:
-                self.index_diff = reader.read_leb128()
-                self.access_flags = reader.read_leb128()
+                self.index_diff, self.access_flags = reader.read_leb128_many(2)
 
     EncodedField = EncodedItem
 
@@ -359,45 +364,38 @@ class DexParser(object):
         VALUE_NULL = 0x1E
         VALUE_BOOLEAN = 0x1F
 
+        # decoders keyed by value type, taking (reader, value_arg); sized types fall back to
+        # a raw byte read when the encoded size does not match, as the elif ladder before did
+        _DECODERS = {
+            VALUE_BYTE: lambda reader, arg: reader.read_byte() if arg + 1 == 1 else reader.read_bytes(arg + 1),
+            VALUE_SHORT: lambda reader, arg: reader.read_short() if arg + 1 == 2 else reader.read_bytes(arg + 1),
+            VALUE_CHAR: lambda reader, arg: chr(reader.read_byte()) if arg + 1 == 1 else reader.read_bytes(arg + 1),
+            VALUE_INT: lambda reader, arg: reader.read_int() if arg + 1 == 4 else reader.read_bytes(arg + 1),
+            # encoding value for long is 8 byte long long
+            VALUE_LONG: lambda reader, arg: reader.read_long_long() if arg + 1 == 8 else reader.read_bytes(arg + 1),
+            VALUE_FLOAT: lambda reader, arg: reader.read_float() if arg + 1 == 4 else reader.read_bytes(arg + 1),
+            VALUE_DOUBLE: lambda reader, arg: reader.read_double() if arg + 1 == 8 else reader.read_bytes(arg + 1),
+            VALUE_STRING: lambda reader, arg: reader.read_fixed_string(arg + 1),
+            VALUE_TYPE: lambda reader, arg: reader.read_bytes(arg + 1),
+            VALUE_FIELD: lambda reader, arg: reader.read_bytes(arg + 1),
+            VALUE_METHOD: lambda reader, arg: reader.read_bytes(arg + 1),
+            VALUE_ENUM: lambda reader, arg: int.from_bytes(reader.read_bytes(arg + 1), 'little'),
+            VALUE_ARRAY: lambda reader, arg: reader.parse_one_item(None, DexParser.EncodedArray),
+            VALUE_ANNOTATION: lambda reader, arg: reader.parse_one_item(None, DexParser.EncodedAnnotation),
+            VALUE_NULL: lambda reader, arg: bytes([]),
+            VALUE_BOOLEAN: lambda reader, arg: reader.read_bytes(arg) != 0,
+        }
+
         def __init__(self, bytestream):
             super(DexParser.EncodedValue, self).__init__(bytestream)
             with ByteStream.ContiguousReader(bytestream) as reader:
                 arg_and_type = reader.read_byte()
                 value_arg = arg_and_type >> 5
                 value_type = arg_and_type & 0x1F
-                if value_type not in [getattr(self, name) for name in dir(self) if name.startswith("VALUE_")]:
+                decode = self._DECODERS.get(value_type)
+                if decode is None:
                     raise Exception("Value type invalid: %s" % value_type)
-                elif value_type == DexParser.EncodedValue.VALUE_BYTE and value_arg + 1 == 1:
-                    self._value = reader.read_byte()
-                elif value_type == DexParser.EncodedValue.VALUE_SHORT and value_arg + 1 == 2:
-                    self._value = reader.read_short()
-                elif value_type == DexParser.EncodedValue.VALUE_INT and value_arg + 1 == 4:
-                    self._value = reader.read_int()
-                elif value_type == DexParser.EncodedValue.VALUE_LONG and value_arg + 1 == 8:
-                    self._value = reader.read_long_long()  # encoding value for long is 8 byte long long
-                elif value_type == DexParser.EncodedValue.VALUE_CHAR and value_arg + 1 == 1:
-                    self._value = chr(reader.read_byte())
-                elif value_type == DexParser.EncodedValue.VALUE_ENUM:
-                    self._value = 0
-                    for index, byte in enumerate(reader.read_bytes(value_arg + 1)):
-                        base = ord(byte) if sys.version_info <= (3,) else byte
-                        self._value += base << index*8  # LITTLE ENDIAN
-                elif value_type == DexParser.EncodedValue.VALUE_FLOAT and value_arg + 1 == 4:
-                    self._value = reader.read_float()
-                elif value_type == DexParser.EncodedValue.VALUE_DOUBLE and value_arg + 1 == 8:
-                    self._value = reader.read_double()
-                elif value_type == DexParser.EncodedValue.VALUE_STRING:
-                    self._value = reader.read_fixed_string(value_arg + 1)
-                elif value_type == DexParser.EncodedValue.VALUE_ARRAY:
-                    self._value = reader.parse_one_item(None, DexParser.EncodedArray)
-                elif value_type == DexParser.EncodedValue.VALUE_ANNOTATION:
-                    self._value = reader.parse_one_item(None, DexParser.EncodedAnnotation)
-                elif value_type == DexParser.EncodedValue.VALUE_NULL:
-                    self._value = bytes([])
-                elif value_type == DexParser.EncodedValue.VALUE_BOOLEAN:
-                    self._value = reader.read_bytes(value_arg) != 0
-                else:
-                    self._value = reader.read_bytes(value_arg + 1)
+                self._value = decode(reader, value_arg)
 
         @property
         def value(self):
@@ -433,15 +431,15 @@ class DexParser(object):
             super(DexParser.TypeIdItem, self).__init__(bytestream)
             self.descriptor_index = index[0]
 
-        @property
+        @functools.cached_property
         def descriptor(self):
-            string_id = self._string_ids[self.descriptor_index]
+            string_id = self._bytestream._string_ids[self.descriptor_index]
             return self._bytestream.parse_descriptor(string_id)
 
     #
     ##########################################################
 
-    JUNIT3_DEFAULT_DESCRIPTORS = {"Ljunit/framework/TestCase;", "Landroid/test/ActivityInstrumentationTestCase;",
+    JUNIT3_DEFAULT_DESCRIPTORS = frozenset({"Ljunit/framework/TestCase;", "Landroid/test/ActivityInstrumentationTestCase;",
                                   "Landroid/test/ActivityInstrumentationTestCase2;", "Landroid/test/ActivityTestCase;",
                                   "Landroid/test/ActivityUnitTestCase;", "Landroid/test/AndroidTestCase;",
                                   "Landroid/test/ApplicationTestCase;", "Landroid/test/FailedToCreateTests;",
@@ -449,7 +447,18 @@ class DexParser(object):
                                   "Landroid/test/ProviderTestCase;", "Landroid/test/ProviderTestCase2;",
                                   "Landroid/test/ServiceTestCase;", "Landroid/test/SingleLaunchActivityTestCase;",
                                   "Landroid/test/SyncBaseInstrumentation;",
-                                  }
+                                  })
+
+    # memoized parse results, keyed on (path, mtime, filters); an apk's contents are
+    # immutable for a given mtime, so repeated parses of the same file are free
+    _parse_cache = {}
+
+    @classmethod
+    def cache_clear(cls):
+        """
+        drop memoized parse results, for callers that rewrite apks in place
+        """
+        cls._parse_cache.clear()
 
     @staticmethod
     def parse(apk_file_name, package_names=None):
@@ -459,23 +468,42 @@ class DexParser(object):
         :param package_names: optional list of packages to filter results
         :return: all test method names for JUnit3 and JUnit4 style tests
         """
-        tempd = tempfile.mkdtemp()
-        try:
-            with zipfile.ZipFile(apk_file_name, mode="r") as zf:
-                for item in [it for it in zf.filelist if it.filename.endswith('.dex')]:
-                    path = os.path.join(tempd, item.filename)
-                    zf.extract(item, tempd)
-                    parser = DexParser(path, package_names)
-                    for test in parser.find_junit3_tests():
-                        yield test
-                    for test in parser.find_junit4_tests():
+        key = (os.path.realpath(apk_file_name), os.stat(apk_file_name).st_mtime_ns,
+               tuple(package_names or ()))
+        cached = DexParser._parse_cache.get(key)
+        if cached is not None:
+            for test in cached:
+                yield test
+            return
+        found = []
+        with zipfile.ZipFile(apk_file_name, mode="r") as zf:
+            # read the dex entries straight out of the zip; no temp-dir extraction round-trip.
+            # only root-level classes*.dex entries hold code -- other .dex files (e.g. under
+            # assets/) are not part of the executable set
+            contents = [zf.read(item) for item in zf.filelist
+                        if item.filename.startswith('classes') and item.filename.endswith('.dex')]
+        if len(contents) <= 1:
+            # stay in-process for the common single-dex case; no spawn overhead
+            for data in contents:
+                for test in _parse_dex_file(data, package_names):
+                    found.append(test)
+                    yield test
+        else:
+            # each dex is independent, so multi-dex apks parse in parallel
+            with futures.ProcessPoolExecutor(max_workers=min(len(contents), os.cpu_count() or 1)) as executor:
+                parse = functools.partial(_parse_dex_file, package_names=package_names)
+                for tests in executor.map(parse, contents):
+                    for test in tests:
+                        found.append(test)
                         yield test
-                    parser.close()
-        finally:
-            shutil.rmtree(tempd)
+        # only a fully drained walk reaches here, so the cached list is complete
+        DexParser._parse_cache[key] = found
 
-    def __init__(self, file_name, package_names=None):
-        self._bytestream = ByteStream(file_name)
+    def __init__(self, file_or_data, package_names=None):
+        if isinstance(file_or_data, bytes):
+            self._bytestream = ByteStream.from_bytes(file_or_data)
+        else:
+            self._bytestream = ByteStream(file_or_data)
         self._headers = DexParser.Header(self._bytestream)
         self._headers.validate()
 
@@ -487,14 +515,20 @@ class DexParser(object):
             if filter_string.startswith('re::'):
                 regex = re.compile(filter_string[4:])
                 return lambda n: bool(re.match(regex, n))
-            elif any([c in filter_string for c in ['*', '[', '?']]):
-                # wildcard syntax filter:
-                return lambda n: bool(fnmatch.fnmatch(n, filter_string))
+            # wildcard syntax filter:
+            return lambda n: bool(fnmatch.fnmatch(n, filter_string))
+
+        # plain prefix filters collapse into a single startswith against a tuple; only
+        # regex and wildcard filters need a compiled matcher each (built once, here)
+        patterned = []
+        prefixes = []
+        for filter_name in package_names or []:
+            if filter_name.startswith('re::') or any([c in filter_name for c in ['*', '[', '?']]):
+                patterned.append(get_filter(filter_name))
             else:
-                return lambda n: bool(n.startswith(filter_string))
-
-        # compile any regex patterns ahead of time and only once here
-        self._package_filters = [get_filter(filter_name) for filter_name in package_names or []]
+                prefixes.append(filter_name)
+        self._package_filters = patterned
+        self._package_prefixes = tuple(prefixes)
         self._ids = {}
         for clazz in [DexParser.StringIdItem, DexParser.TypeIdItem, DexParser.ProtoIdItem,
                       DexParser.FieldIdItem, DexParser.MethodIdItem, DexParser.ClassDefItem]:
@@ -502,30 +536,100 @@ class DexParser(object):
 
             self._ids[clazz] = ByteStream.CollectionReader(self._bytestream, count=size, offset=offset, clazz=clazz)
             if clazz == DexParser.TypeIdItem:
-                DexParser.Item._type_ids = self._ids[clazz]
+                self._bytestream._type_ids = self._ids[clazz]
             elif clazz == DexParser.StringIdItem:
-                DexParser.Item._string_ids = self._ids[clazz]
+                self._bytestream._string_ids = self._ids[clazz]
 
     def close(self):
-        self._bytestream._file.close()
+        self._bytestream.close()
+
+    def _matches_package_filters(self, dot_sep_name):
+        """
+        :param dot_sep_name: dot-separated class name to test
+        :return: whether the name passes the package filters (trivially true when there are none)
+        """
+        if not self._package_prefixes and not self._package_filters:
+            return True
+        if self._package_prefixes and dot_sep_name.startswith(self._package_prefixes):
+            return True
+        return any(f(dot_sep_name) for f in self._package_filters)
+
+
+    def _find_string_index(self, value):
+        """
+        :param value: exact string to look for
+        :return: index of the string in the string-id table, or -1 if absent.  The dex spec
+        keeps the string table sorted by content, so a binary search costs only O(log n)
+        string decodes
+        """
+        string_ids = self._ids[DexParser.StringIdItem]
+        low = 0
+        high = string_ids._count
+        while low < high:
+            mid = (low + high) // 2
+            mid_value = self._bytestream.parse_descriptor(string_ids[mid])
+            if mid_value < value:
+                low = mid + 1
+            elif mid_value > value:
+                high = mid
+            else:
+                return mid
+        return -1
+
+    def _matching_type_indices(self, descriptors):
+        """
+        :param descriptors: iterable of descriptor-style class names
+        :return: set of type-id indices whose descriptors match one of the given names
+        """
+        wanted_string_indices = set()
+        for descriptor in descriptors:
+            index = self._find_string_index(descriptor)
+            if index >= 0:
+                wanted_string_indices.add(index)
+        if not wanted_string_indices:
+            return set()
+        type_ids = self._ids[DexParser.TypeIdItem]
+        if sys.byteorder == 'little':
+            # scan the raw descriptor-index ints; no TypeIdItem objects needed
+            raw = type_ids._buf.cast('i')
+            return {index for index in range(type_ids._count) if raw[index] in wanted_string_indices}
+        return {index for index in range(type_ids._count)
+                if type_ids[index].descriptor_index in wanted_string_indices}
 
     def find_classes_directly_inherited_from(self, descriptors):
         """
         :param descriptors: descriptor-style list of class names
         :return: all classes that are directly inherited form one of the classes described by the descriptors
         """
-        fixed_set = set(descriptors)
-        for clazz in [c for c in self._ids[DexParser.ClassDefItem] if c.has_direct_super_class(fixed_set)]:
-            type_id = self._ids[DexParser.TypeIdItem][clazz.class_index]
-            string_id = self._ids[DexParser.StringIdItem][type_id.descriptor_index]
-            descriptors.append(self._bytestream.parse_descriptor(string_id))
-            yield clazz
+        # resolve the sought descriptors to type indices once, so the per-class check is a
+        # plain int membership test with no descriptor decoding at all
+        wanted = self._matching_type_indices(set(descriptors))
+        if not wanted:
+            return
+        # index the class defs by their super type in one pass, then walk outward from the
+        # wanted types; every class is visited once no matter how deep the inheritance
+        # chains run.  the old code appended matched descriptors to the caller's list but
+        # never consulted them, so transitive matches were silently dropped
+        by_super = {}
+        for clazz in self._ids[DexParser.ClassDefItem]:
+            by_super.setdefault(clazz.super_class_index, []).append(clazz)
+        seen = set(wanted)
+        queue = collections.deque(wanted)
+        while queue:
+            for clazz in by_super.get(queue.popleft(), ()):
+                if clazz.class_index not in seen:
+                    seen.add(clazz.class_index)
+                    queue.append(clazz.class_index)
+                    yield clazz
 
     def find_method_names(self, class_def):
         """
         :param class_def: `DexParser.ClassDefItem` from which to find names
         :return: all method names for a given class def
         """
+        if class_def.class_data_offset == 0:
+            # marker interfaces/abstract classes carry no class data; nothing to walk
+            return
         with ByteStream.ContiguousReader(bytestream=self._bytestream, offset=class_def.class_data_offset):
             class_data = DexParser.ClassDefData(self._bytestream)
         for m in class_data.virtual_methods:
@@ -538,38 +642,74 @@ class DexParser(object):
         """
         return name[1:-1].replace('/', '.')
 
-    def find_junit3_tests(self, descriptors=list(JUNIT3_DEFAULT_DESCRIPTORS)):
+    def find_junit3_tests(self, descriptors=None):
         """
-        :param descriptors:  which test classes to look for as proper test case classes
+        :param descriptors:  which test classes to look for as proper test case classes,
+        defaulting to the standard JUnit3 base classes
         :return: all test methods per Junit3 conventions
         """
+        if descriptors is None:
+            descriptors = DexParser.JUNIT3_DEFAULT_DESCRIPTORS
         for class_def in self.find_classes_directly_inherited_from(descriptors):
             dot_sep_name = self._descriptor2name(class_def.descriptor)
-            if not self._package_filters or any([f(dot_sep_name) for f in self._package_filters]):
+            if self._matches_package_filters(dot_sep_name):
                 for method in self.find_method_names(class_def):
                     if method.startswith("test"):
                         yield method
 
+    def _find_type_index(self, descriptor):
+        """
+        :param descriptor: descriptor-style class name
+        :return: index into the type-id table for that descriptor, or -1 if absent
+        """
+        indices = self._matching_type_indices([descriptor])
+        return indices.pop() if indices else -1
+
     def find_junit4_tests(self):
         """
         :return: all tests annotated under Junit4 conventions
         """
-        test_annotation_descriptor = "Lorg/junit/Test;"
-        ignored_annotation_descriptor = "Lorg/junit/Ignore;"
+        # resolve the annotation descriptors to type indices up front; if @Test does not
+        # exist in this dex at all there is nothing to scan
+        test_type_index = self._find_type_index("Lorg/junit/Test;")
+        if test_type_index < 0:
+            return
+        ignored_type_index = self._find_type_index("Lorg/junit/Ignore;")
         for class_def in [c for c in self._ids[DexParser.ClassDefItem] if c.annotations_offset != 0]:
                 dot_sep_name = self._descriptor2name(class_def.descriptor)
-                if not self._package_filters or any([f(dot_sep_name) for f in self._package_filters]):
+                if self._matches_package_filters(dot_sep_name):
+                    with ByteStream.ContiguousReader(self._bytestream, offset=class_def.annotations_offset) as reader:
+                        # many classes carry only class/field/parameter annotations; peek at
+                        # the method count in the directory header and skip those outright
+                        if reader.read_ints(3)[2] == 0:
+                            continue
                     with ByteStream.ContiguousReader(self._bytestream, offset=class_def.annotations_offset):
                         directory = DexParser.AnnotationsDirectoryItem(self._bytestream)
-                    ignored_names = [n for n in directory.get_methods_with_annotation(ignored_annotation_descriptor,
-                                                                                      self._ids[DexParser.MethodIdItem])]
+                    ignored_names = directory.get_methods_with_annotation(ignored_type_index,
+                                                                           self._ids[DexParser.MethodIdItem])
 
-                    for name in directory.get_methods_with_annotation(test_annotation_descriptor,
+                    for name in directory.get_methods_with_annotation(test_type_index,
                                                                       self._ids[DexParser.MethodIdItem]):
                         if name not in ignored_names:
                             yield dot_sep_name + "#" + name
 
 
+def _parse_dex_file(data, package_names=None):
+    """
+    Module-level so a worker process can pickle and run it
+    :param data: raw bytes of one dex file
+    :param package_names: optional list of packages to filter results
+    :return: list of all JUnit3 and JUnit4 style test names in that dex
+    """
+    parser = DexParser(data, package_names)
+    try:
+        tests = set(parser.find_junit3_tests())
+        tests.update(parser.find_junit4_tests())
+        return tests
+    finally:
+        parser.close()
+
+
 class AXMLParser(object):
     """
     Class for extracting a human-readable android manifest xml file from an Android apk
@@ -585,6 +725,14 @@ class AXMLParser(object):
     START_NS = 0x00100100
     END_NS = 0x00100101
 
+    # item factory per chunk-type word; END_NS shares its value with XML_END_DOC_TAG,
+    # for which the document-end action takes precedence (as the old branch order had it)
+    _ITEM_FACTORIES = {
+        XML_START_TAG: lambda self, bytestream: AXMLParser.XMLTag(self, bytestream, True),
+        XML_START_END_TAG: lambda self, bytestream: AXMLParser.XMLTag(self, bytestream, False),
+        START_NS: lambda self, bytestream: AXMLParser.NSRecord(bytestream, True),
+    }
+
     # These classes mimic the AndroidManifest.xml structure
 
     class Instrumentation(object):
@@ -638,6 +786,7 @@ class AXMLParser(object):
 
     def __init__(self, bytestream):
         self._header = AXMLParser.Header(bytestream)
+        self._strings = self._decode_string_pool(bytestream)
         tag_list = self.parse_items(bytestream=bytestream)
         #  ns_list = [item for item in tag_list if isinstance(item, AXMLParser.NSRecord)]
         xml_tag_list = [item for item in tag_list if isinstance(item, AXMLParser.XMLTag)]
@@ -657,24 +806,21 @@ class AXMLParser(object):
                 else:  # end tag
                     current_tag = current_tag.parent_tag
         self._process_tags()
-        bytestream._file.close()
+        bytestream.close()
 
     def parse_items(self, bytestream):
         with ByteStream.ContiguousReader(bytestream) as reader:
             items = []
+            factories = AXMLParser._ITEM_FACTORIES
             while True:
-                first_word = reader.read_int()
-                reader.read_int()  # unused chunk size
-                reader.read_int()  # unused line number
-                reader.read_int()  # unused, unknown
-                if first_word in [AXMLParser.XML_START_TAG, AXMLParser.XML_START_END_TAG]:
-                    items.append(AXMLParser.XMLTag(self, bytestream, first_word == AXMLParser.XML_START_TAG))
-                elif first_word == AXMLParser.XML_END_DOC_TAG:
+                # chunk size, line number and a fourth unknown word follow the type and are unused
+                first_word = reader.read_ints(4)[0]
+                if first_word == AXMLParser.XML_END_DOC_TAG:
                     break
-                elif first_word in [AXMLParser.START_NS, AXMLParser.END_NS]:
-                    items.append(AXMLParser.NSRecord(bytestream, first_word == AXMLParser.START_NS))
-                else:
+                factory = factories.get(first_word)
+                if factory is None:
                     raise Exception("Invalid XML element start code %d in android xml" % first_word)
+                items.append(factory(self, bytestream))
             return items
 
     def _process_tags(self):
@@ -772,24 +918,24 @@ class AXMLParser(object):
                 self.no_entries = self._resource_chunk_size/4
                 reader.skip(self._resource_chunk_size - 8)
 
-    class StringItem(object):
-
-        FORMAT = None
-
-        def __init__(self, bytestream):
-            with ByteStream.ContiguousReader(bytestream) as reader:
-                self._length = reader.read_short()
-                if int(self._length/256) == self._length % 256:
-                    self._length = self._length % 256  # newer Axml seems to dup the length (??)
-                    bytes = reader.read_bytes(self._length)
-                    text = bytes.decode('utf-8')
-                else:
-                    bytes = reader.read_bytes(self._length*2)
-                    text = bytes.decode('utf-16')
-                self._value = text
-
-        def __str__(self):
-            return self._value if self._value is not None else ""
+    @staticmethod
+    def _decode_string(bytestream):
+        with ByteStream.ContiguousReader(bytestream) as reader:
+            length = reader.read_short()
+            if (length >> 8) == (length & 0xFF):
+                length &= 0xFF  # newer Axml seems to dup the length (??)
+                bytes = reader.read_bytes(length)
+                # most manifest strings are plain ascii; isascii + the ascii codec skip
+                # the utf-8 state machine for those
+                text = bytes.decode('ascii') if bytes.isascii() else bytes.decode('utf-8')
+            else:
+                bytes = reader.read_bytes(length*2)
+                # axml is always little-endian and carries no BOM, so name the byte order
+                # explicitly rather than have the codec sniff for one on every string
+                text = bytes.decode('utf-16-le')
+            # element and attribute names repeat constantly; interning makes the repeats
+            # share one object.  long strings are left alone to keep the intern table small
+            return sys.intern(text) if len(text) <= 64 else text
 
     class XMLAttr(object):
         # 0th word: string index of attribute's namespace name or -1 if default namespace
@@ -798,33 +944,35 @@ class AXMLParser(object):
         # 3rd word: unused (flags of some sort?)
         # 4th word: resource id, if used
 
-        def __init__(self, parser, bytestream):
-            with ByteStream.ContiguousReader(bytestream) as reader:
-                ns_offset = reader.read_int()
-                name_offset = reader.read_int()
-                val_offset = reader.read_int()
-                reader.read_int()  # unused
-                resourceId = reader.read_int()
-                self._ns = parser._get_string(bytestream, ns_offset) if ns_offset >= 0 else ""
-                self._name = parser._get_string(bytestream, name_offset)
-                self._value = parser._get_string(bytestream, val_offset) if val_offset >= 0 else None
-                if self._value is None and resourceId >= 0:
-                    self._value = "resourceID " + hex(resourceId)
+        __slots__ = ('_ns', '_name', '_value')
+
+        def __init__(self, parser, vals):
+            ns_offset, name_offset, val_offset, _, resourceId = vals
+            self._ns = parser._get_string(ns_offset) if ns_offset >= 0 else ""
+            self._name = parser._get_string(name_offset)
+            self._value = parser._get_string(val_offset) if val_offset >= 0 else None
+            if self._value is None and resourceId >= 0:
+                self._value = "resourceID " + hex(resourceId)
 
         @property
         def name(self):
-            return str(self._name)
+            return self._name
 
         @property
         def value(self):
-            return str(self._value)
+            return self._value
 
         @classmethod
         def get(cls, parser, bytestream, count):
-            return [cls(parser, bytestream) for _ in range(count)]
+            if count == 0:
+                return []
+            # pull the whole five-words-per-attribute array in one read and carve it up
+            with ByteStream.ContiguousReader(bytestream) as reader:
+                words = reader.read_ints(count * 5)
+            return [cls(parser, words[start:start + 5]) for start in range(0, count * 5, 5)]
 
         def __str__(self):
-            return "%s='%s'" % (self._name, self._value) if self._value is not None else str(self._name)
+            return f"{self._name}='{self._value}'" if self._value is not None else self._name
 
     class XMLTag(object):
 
@@ -840,20 +988,20 @@ class AXMLParser(object):
         #   7th word: number of attributes in element
         #   8th word: unused
 
+        __slots__ = ('_is_start_tag', '_attr_count', '_attributes', '_ns_name', '_element_name',
+                     'children', 'parent_tag')
+
         def __init__(self, parser, bytestream, is_start_tag):
             self._is_start_tag = is_start_tag
             with ByteStream.ContiguousReader(bytestream) as reader:
-                ns_offset = reader.read_int()
-                element_name_offset = reader.read_int()
-                if self._is_start_tag:  # elements have 3 more words:
-                    reader.read_int()  # unused
-                    self._attr_count = reader.read_int()
-                    reader.read_int()  # unused
+                if self._is_start_tag:  # elements have 3 more words, of which only the attr count matters
+                    (ns_offset, element_name_offset, _, self._attr_count, _) = reader.read_ints(5)
                     self._attributes = AXMLParser.XMLAttr.get(parser, bytestream, self._attr_count)
                 else:
+                    ns_offset, element_name_offset = reader.read_ints(2)
                     self._attributes = []
-                self._ns_name = parser._get_string(bytestream, ns_offset) if ns_offset >= 0 else ""
-                self._element_name = parser._get_string(bytestream, element_name_offset)
+                self._ns_name = parser._get_string(ns_offset) if ns_offset >= 0 else ""
+                self._element_name = parser._get_string(element_name_offset)
                 self.children = []
                 self.parent_tag = None
 
@@ -871,45 +1019,54 @@ class AXMLParser(object):
 
         @property
         def name(self):
-            return str(self._element_name)
-
-        @classmethod
-        def get(cls, bytestream, count):
-            tags = []
-            while True:
-                tag = cls(bytestream)
-                tags.append(tag)
-            return tags
+            return self._element_name
 
         def __str__(self):
-            content = " ".join([str(attr) for attr in self._attributes])
-            child_content = "\n  ".join([str(child) for child in self.children])
-            text = "<%(name)s  %(content)s>\n  %(children)s\n</%(name)s>" % {
-                'name': self._element_name,
-                'content': content,
-                'children': child_content
-            }
-            return text
+            content = " ".join(str(attr) for attr in self._attributes)
+            child_content = "\n  ".join(str(child) for child in self.children)
+            return f"<{self._element_name}  {content}>\n  {child_content}\n</{self._element_name}>"
 
     class NSRecord(object):
 
+        __slots__ = ('_is_start', '_prefix', '_uri')
+
         def __init__(self, bytestream, is_start):
             self._is_start = is_start
             with ByteStream.ContiguousReader(bytestream) as reader:
-                self._prefix = reader.read_int()
-                self._uri = reader.read_int()
+                self._prefix, self._uri = reader.read_ints(2)
 
-    def _get_string(self, bytestream, str_index):
+    def _decode_string_pool(self, bytestream):
+        """
+        decode every string-table entry once, up front; tag and attribute parsing then
+        resolve string references with a list index instead of a seek-and-decode per lookup
+        """
+        base = self._header._string_raw_data_offset
+        position = bytestream.tell()
+        try:
+            strings = []
+            for offset in self._header._string_offset:
+                bytestream.seek(base + offset)
+                strings.append(self._decode_string(bytestream))
+            return strings
+        finally:
+            bytestream.seek(position)
+
+    def _get_string(self, str_index):
         if str_index < 0:
             return None
-        if str_index >= len(self._header._string_offset):
+        if str_index >= len(self._strings):
             return ""
-        offset = bytestream.tell()
-        try:
-            bytestream.seek(self._header._string_raw_data_offset + self._header._string_offset[str_index])
-            return AXMLParser.StringItem(bytestream)
-        finally:
-            bytestream.seek(offset)
+        return self._strings[str_index]
+
+    # memoized parsers keyed on (path, mtime); a manifest is immutable for a given mtime
+    _parse_cache = {}
+
+    @classmethod
+    def cache_clear(cls):
+        """
+        drop memoized parsers, for callers that rewrite apks in place
+        """
+        cls._parse_cache.clear()
 
     @staticmethod
     def parse(apk_file_name):
@@ -918,14 +1075,30 @@ class AXMLParser(object):
         :param apk_file_name: path to apk to parse
         :return: all xml tags
         """
-        tempd = tempfile.mkdtemp()
-        with zipfile.ZipFile(apk_file_name, mode="r") as zf:
-            zf.extract("AndroidManifest.xml", tempd)
-            bytestream = ByteStream(os.path.join(str(tempd), "AndroidManifest.xml"))
-            parser = AXMLParser(bytestream)
-        shutil.rmtree(tempd)
+        key = (os.path.realpath(apk_file_name), os.stat(apk_file_name).st_mtime_ns)
+        parser = AXMLParser._parse_cache.get(key)
+        if parser is None:
+            with zipfile.ZipFile(apk_file_name, mode="r") as zf:
+                # decompress the manifest straight into memory; no temp-dir extraction round-trip
+                data = zf.read("AndroidManifest.xml")
+            parser = AXMLParser(ByteStream.from_bytes(data))
+            AXMLParser._parse_cache[key] = parser
         return parser
 
+    @staticmethod
+    def parse_many(apk_file_names):
+        """
+        parse manifests for a batch of apks, fanning out across processes when there is
+        more than one to do
+        :param apk_file_names: paths of apks to parse
+        :return: list of `AXMLParser` instances, in the same order as the given paths
+        """
+        apk_file_names = list(apk_file_names)
+        if len(apk_file_names) <= 1:
+            return [AXMLParser.parse(name) for name in apk_file_names]
+        with futures.ProcessPoolExecutor(max_workers=min(len(apk_file_names), os.cpu_count() or 1)) as executor:
+            return list(executor.map(AXMLParser.parse, apk_file_names))
+
     @property
     def xml(self):
         return str(self.xml_head)
@@ -951,5 +1124,5 @@ def main_axml():
     if len(sys.argv) < 2:
         sys.exit(-1)
     else:
-        parser = AXMLParser.parse(sys.argv[1])
-        sys.stdout.write(parser.xml)
+        for parser in AXMLParser.parse_many(sys.argv[1:]):
+            sys.stdout.write(parser.xml)
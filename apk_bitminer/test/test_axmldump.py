@@ -10,7 +10,7 @@ BASIC_APK = os.path.join(RESOURCE_DIR, "test5.apk")
 COMPLEX_APK = os.path.join(RESOURCE_DIR, "test3.apk")
 USER_ACCEPTANCE_APK = os.path.join(RESOURCE_DIR, "test4.apk")
 
-EXPECTED_XML = str("""<manifest  package='com.linkedin.mdctest.test' platformBuildVersionCode='25' platformBuildVersionName='7.1.1'>
+EXPECTED_XML = """<manifest  package='com.linkedin.mdctest.test' platformBuildVersionCode='25' platformBuildVersionName='7.1.1'>
   <uses-sdk  minSdkVersion='resourceID 0xf' targetSdkVersion='resourceID 0x19'>
   
 </uses-sdk>
@@ -22,7 +22,7 @@ EXPECTED_XML = str("""<manifest  package='com.linkedin.mdctest.test' platformBui
   
 </uses-library>
 </application>
-</manifest>""")  # noqa
+</manifest>"""  # noqa
 
 
 class TestAXMLParsing(object):